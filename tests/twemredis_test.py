@@ -3,7 +3,13 @@
 unit tests for twemredis.py
 """
 from builtins import bytes, chr
+import hashlib
+import os
+import signal
+import tempfile
 import unittest
+from unittest import mock
+from redis.exceptions import NoScriptError
 import twemredis
 import mockredis
 import yaml
@@ -30,11 +36,11 @@ class TestTwemRedis(twemredis.TwemRedis):
     _init_redis_shard methods are overriden.
     """
     def _parse_config(self, config):
-        return yaml.load(config)
+        return yaml.safe_load(config)
 
     # create mockredis shard instances
     def _init_redis_shards(self):
-        self._shards = {}
+        self._shards = [None] * self.num_shards()
         for shard_num in range(0, self.num_shards()):
             mock_shard = mockredis.mock_strict_redis_client()
             # for testing
@@ -52,6 +58,29 @@ class TwemRedisTests(unittest.TestCase):
         # Basic check by calling num_shards()
         self.assertEqual(10, self.tr.num_shards())
 
+    def test_parse_config_file(self):
+        (fd, path) = tempfile.mkstemp(suffix='.yml')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(test_yaml)
+            config = twemredis.TwemRedis._parse_config(self.tr, path)
+            self.assertEqual(10, config['num_shards'])
+            self.assertEqual('{}', config['hash_tag'])
+            # changes to the returned config must not leak into the cache
+            config['sentinels'].append('sentinel04.example.com')
+            config = twemredis.TwemRedis._parse_config(self.tr, path)
+            self.assertEqual(3, len(config['sentinels']))
+            # rewriting the file invalidates the cached config, even if the
+            # filesystem's timestamps are too coarse to notice
+            st = os.stat(path)
+            with open(path, 'w') as f:
+                f.write(test_yaml.replace('num_shards: 10', 'num_shards: 100'))
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            config = twemredis.TwemRedis._parse_config(self.tr, path)
+            self.assertEqual(100, config['num_shards'])
+        finally:
+            os.remove(path)
+
     def test_get_key(self):
         self.assertEqual('friend_request:{123456}',
                          self.tr.get_key('friend_request', '123456'))
@@ -77,6 +106,73 @@ class TwemRedisTests(unittest.TestCase):
         self.assertEqual('shard_state:{12}',
                          self.tr.get_canonical_key('shard_state', 'banana'))
 
+    def test_non_ascii_key_id(self):
+        # twemproxy hashes the raw utf-8 bytes of the key. The md5 of
+        # 'caf\xc3\xa9' as a little-endian int is 0xe47f1107, i.e. shard 9.
+        self.assertEqual(0xe47f1107 % 10,
+                         self.tr.get_shard_num_by_key_id(u'caf\xe9'))
+
+    def test_hash_tag_key_id(self):
+        # the contents of the hash tags are used as the key id
+        self.assertEqual(self.tr.get_shard_num_by_key_id('123456'),
+                         self.tr.get_shard_num_by_key('friends:{123456}'))
+        # keys without complete hash tags hash the entire key
+        for key in ['friends:123456', 'friends:{123456', 'friends:}123456']:
+            self.assertEqual(self.tr.get_shard_num_by_key_id(key),
+                             self.tr.get_shard_num_by_key(key))
+
+    def test_fnv1a_hash(self):
+        # Expected values below come from twemproxy's nc_fnv.c. Bytes of
+        # non-ASCII keys are sign-extended since twemproxy hashes chars.
+        tr = TestTwemRedis(test_yaml + 'hash: fnv1a_32\n')
+        self.assertEqual(0x9995b6aa % 10, tr.get_shard_num_by_key_id('123456'))
+        self.assertEqual(0x0e3d64cf % 10,
+                         tr.get_shard_num_by_key_id(u'\xfcber'))
+        # canonical keys are computed with the configured hash
+        for shard_num in range(0, tr.num_shards()):
+            key_id = tr.get_canonical_key_id_for_shard(shard_num)
+            self.assertEqual(shard_num, tr.get_shard_num_by_key_id(key_id))
+
+    def test_fnv1a_64_hash(self):
+        # twemproxy's fnv1a_64 truncates its constants to 32 bits
+        tr = TestTwemRedis(test_yaml + 'hash: fnv1a_64\n')
+        self.assertEqual(0x0e67290a % 10, tr.get_shard_num_by_key_id('123456'))
+        self.assertEqual(0x708511af % 10,
+                         tr.get_shard_num_by_key_id(u'\xfcber'))
+
+    def test_unsupported_hash_raises_error(self):
+        self.assertRaises(ValueError, TestTwemRedis,
+                          test_yaml + 'hash: crc16\n')
+
+    def test_single_shard(self):
+        tr = TestTwemRedis(test_yaml.replace('num_shards: 10',
+                                             'num_shards: 1'))
+        self.assertEqual(0, tr.get_shard_num_by_key('friends:{123456}'))
+        self.assertEqual('1', tr.get_canonical_key_id('banana'))
+        tr.set('cat', b'meow')
+        tr.set('dog', b'bark')
+        self.assertEqual({0: [b'meow', b'bark']}, tr.mget(['cat', 'dog']))
+        # no keys means no shards were queried, as with more shards
+        self.assertEqual({}, tr.mget([]))
+        tr.mset({'cow': b'moo'})
+        self.assertEqual(b'moo', tr.get('cow'))
+
+    def test_invalid_hash_tag_raises_error(self):
+        self.assertRaises(ValueError, TestTwemRedis,
+                          test_yaml.replace('"{}"', '"{{}}"'))
+
+    def test_get_canonical_key_id_types(self):
+        # equal key ids of different types are hashed by their str form
+        self.assertEqual(self.tr.get_canonical_key_id('True'),
+                         self.tr.get_canonical_key_id(True))
+        self.assertEqual(self.tr.get_canonical_key_id('1.0'),
+                         self.tr.get_canonical_key_id(1.0))
+        self.assertEqual(self.tr.get_canonical_key_id('1'),
+                         self.tr.get_canonical_key_id(1))
+        # unhashable key ids work too
+        self.assertEqual(self.tr.get_canonical_key_id("['a']"),
+                         self.tr.get_canonical_key_id(['a']))
+
     def test_get_invalid_shard_raises_error(self):
         try:
             # This should throw an exception.
@@ -86,6 +182,11 @@ class TwemRedisTests(unittest.TestCase):
         else:
             print('ValueError was not raised.')
             self.assertTrue(False)
+        # as should a shard past the end of the cluster, without exposing
+        # the internal IndexError
+        with self.assertRaises(ValueError) as cm:
+            self.tr.get_shard_by_num(self.tr.num_shards())
+        self.assertIsNone(cm.exception.__context__)
 
     def test_auto_sharding_get_set(self):
         self.tr.set('12345', 'bananas')
@@ -125,6 +226,10 @@ class TwemRedisTests(unittest.TestCase):
         self.assertEqual(b'bar', bar[0])
         self.assertEqual(2.0, bar[1])
 
+    def test_auto_sharding_disallowed_operations(self):
+        self.assertRaises(Exception, self.tr.scan, 0)
+        self.assertRaises(Exception, self.tr.zscan, 'testset')
+
     def test_compute_canonical_key_ids(self):
         canonical_keys = self.tr.compute_canonical_key_ids()
         for i in range(0, len(canonical_keys)):
@@ -179,6 +284,21 @@ class TwemRedisTests(unittest.TestCase):
             self.assertTrue(bytes('foo{0}'.format(shard_num), 'utf8')
                             in keys[shard_num])
 
+    def test_route(self):
+        keys = ['cat', 'cow', 'dog', 'pig', 'sheep', 'friends:{123456}']
+        key_map = self.tr.route(keys)
+        # every key is routed exactly once, to the shard it belongs to
+        routed = []
+        for shard_num, shard_keys in key_map.items():
+            self.assertTrue(len(shard_keys) > 0)
+            for key in shard_keys:
+                self.assertEqual(shard_num, self.tr.get_shard_num_by_key(key))
+            routed.extend(shard_keys)
+        self.assertEqual(sorted(keys), sorted(routed))
+        # a dictionary is routed by its keys
+        values = dict((key, key.upper()) for key in keys)
+        self.assertEqual(key_map, self.tr.route(values))
+
     def test_mget(self):
         input_dict = {
             'cat': b'meow',
@@ -193,6 +313,9 @@ class TwemRedisTests(unittest.TestCase):
         # perform mget
         results = self.tr.mget(input_dict)
         result_count = 0
+        # only lists of values should come back
+        for result in results.values():
+            self.assertTrue(isinstance(result, list))
         # validate all the values are what we expect
         for result in results.values():
             result_count += len(result)
@@ -201,6 +324,53 @@ class TwemRedisTests(unittest.TestCase):
         # sanity check got the right number of results back
         self.assertEqual(len(input_dict), result_count)
 
+    def test_mget_no_keys(self):
+        # no keys means no shards are queried
+        self.assertEqual({}, self.tr.mget([]))
+
+    def test_mget_skips_unused_shards(self):
+        self.tr.set('cat', b'meow')
+        results = self.tr.mget(['cat'])
+        # only the shard holding the key should have been queried
+        shard_num = self.tr.get_shard_num_by_key('cat')
+        self.assertEqual({shard_num: [b'meow']}, results)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_mget_after_fork(self):
+        # spread the keys over several shards so the thread pool is used
+        keys = [self.tr.get_canonical_key('fork', key_id)
+                for key_id in test_canonical_keys]
+        for key in keys:
+            self.tr.set(key, b'foo')
+        self.tr.mget(keys)
+        pid = os.fork()
+        if pid == 0:
+            # the child must not wait on the parent's worker threads
+            signal.alarm(5)
+            try:
+                results = self.tr.mget(keys)
+                os._exit(0 if len(results) == len(keys) else 1)
+            except BaseException:
+                os._exit(2)
+        (_, status) = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+    def test_shutdown_pool(self):
+        # no pool is needed when there are no keys
+        self.assertEqual(0, self.tr.mset({}))
+        self.assertEqual({}, self.tr.mget([]))
+        self.assertIsNone(self.tr._pool)
+        # spread the keys over several shards so the thread pool is used
+        keys = [self.tr.get_canonical_key('pool', key_id)
+                for key_id in test_canonical_keys]
+        self.tr.mget(keys)
+        self.assertIsNotNone(self.tr._pool)
+        self.tr.shutdown_pool()
+        self.assertIsNone(self.tr._pool)
+        # the pool is recreated if needed after shutting it down
+        self.assertEqual(len(keys), len(self.tr.mget(keys)))
+        self.tr.shutdown_pool()
+
     def test_mset(self):
         input_dict = {
             'cat': b'meow',
@@ -220,6 +390,62 @@ class TwemRedisTests(unittest.TestCase):
         # sanity check we got the right number of results back
         self.assertEqual(len(input_dict), result_count)
 
+    def test_mexecute(self):
+        input_dict = {
+            'cat': ('sound', 'meow'),
+            'cow': ('sound', 'moo'),
+            'dog': ('sound', 'bark'),
+        }
+        # perform hset on every key in as few pipelines as possible
+        results = self.tr.mexecute('hset', input_dict)
+        result_count = 0
+        for result in results.values():
+            result_count += len(result)
+        self.assertEqual(len(input_dict), result_count)
+        # validate each hash was written to the right shard
+        for key in input_dict.keys():
+            field, value = input_dict[key]
+            self.assertEqual(bytes(value, 'utf8'), self.tr.hget(key, field))
+
+    def test_load_script_on_all_shards(self):
+        sha = self.tr.load_script_on_all_shards('one', 'return 1')
+        self.assertEqual(hashlib.sha1(b'return 1').hexdigest(), sha)
+        # validate the script was loaded on every shard
+        for shard_num in range(0, self.tr.num_shards()):
+            shard = self.tr.get_shard_by_num(shard_num)
+            self.assertEqual([True], shard.script_exists(sha))
+
+    def test_evalsha_on_shard(self):
+        sha = self.tr.load_script_on_all_shards('one', 'return 1')
+        # mockredis can't run Lua, so stand in for the key's shard
+        shard_num = self.tr.get_shard_num_by_key('cat')
+        shard = mock.Mock()
+        shard.evalsha.return_value = 1
+        self.tr._shards[shard_num] = shard
+        self.assertEqual(1, self.tr.evalsha_on_shard('one', 'cat', 'a', 2))
+        shard.evalsha.assert_called_once_with(sha, 1, 'cat', 'a', 2)
+        shard.script_load.assert_not_called()
+
+    def test_evalsha_on_shard_reloads_script(self):
+        sha = self.tr.load_script_on_all_shards('one', 'return 1')
+        shard_num = self.tr.get_shard_num_by_key('cat')
+        # simulate a shard that lost its script cache, e.g. after failover
+        shard = mock.Mock()
+        shard.evalsha.side_effect = [NoScriptError('NOSCRIPT'), 1]
+        self.tr._shards[shard_num] = shard
+        self.assertEqual(1, self.tr.evalsha_on_shard('one', 'cat', 'a'))
+        shard.script_load.assert_called_once_with('return 1')
+        self.assertEqual([mock.call(sha, 1, 'cat', 'a')] * 2,
+                         shard.evalsha.call_args_list)
+
+    def test_register_script_is_forwarded(self):
+        # StrictRedis.register_script still reaches a shard unchanged
+        self.assertIsNotNone(self.tr.register_script('return 1'))
+
+    def test_eval_unknown_script_raises_error(self):
+        self.assertRaises(ValueError, self.tr.evalsha_on_shard,
+                          'nope', 'cat')
+
     def test_mget_all_shards_canonical(self):
         canonical_keys = []
         # set all the canonical keys by shard
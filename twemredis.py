@@ -4,15 +4,72 @@ twemproxy/nutcracker sharded Redis library for Python.
 - Talks to the Sentinels to obtain the Redis shards
 """
 
-import collections
-import hashlib
-import re
-
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from functools import lru_cache
+from hashlib import md5 as _md5
+from hashlib import sha1 as _sha1
+import os
+from struct import Struct
+
+import redis
+from redis.exceptions import NoScriptError
 from redis.sentinel import Sentinel
 import yaml
 
 __all__ = ['TwemRedis']
 
+# Use libyaml's C parser when PyYAML was built with it.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Reads the first four bytes of a digest as a little-endian integer.
+_U32LE = Struct('<I')
+
+# Parsed config files, keyed by path, along with their (mtime, size) when
+# parsed.
+_config_cache = {}
+
+
+def _md5_hash(data):
+    """
+    _md5_hash emulates twemproxy's md5 hash, which uses the first four bytes
+    of the md5 digest as a little-endian integer.
+    """
+    # Same as d[0] | d[1] << 8 | d[2] << 16 | d[3] << 24 in
+    # https://github.com/twitter/twemproxy/blob/master/src/hashkit/nc_md5.c
+    return _U32LE.unpack_from(_md5(data).digest())[0]
+
+
+def _fnv1a_hash(data, init, prime):
+    """
+    _fnv1a_hash emulates twemproxy's 32-bit FNV-1a loop. Like twemproxy, the
+    bytes are treated as signed chars, so bytes >= 0x80 are sign-extended.
+    See https://github.com/twitter/twemproxy/blob/master/src/hashkit/nc_fnv.c
+    """
+    val = init
+    for c in bytearray(data):
+        if c & 0x80:
+            c |= 0xffffff00
+        val = ((val ^ c) * prime) & 0xffffffff
+    return val
+
+
+def _fnv1a_64_hash(data):
+    # twemproxy truncates the 64-bit FNV constants to 32 bits.
+    return _fnv1a_hash(data, 0x84222325, 0x1b3)
+
+
+def _fnv1a_32_hash(data):
+    return _fnv1a_hash(data, 0x811c9dc5, 0x01000193)
+
+
+# Maps the twemproxy 'hash' setting to the function emulating it.
+_HASH_FUNCTIONS = {
+    'md5': _md5_hash,
+    'fnv1a_64': _fnv1a_64_hash,
+    'fnv1a_32': _fnv1a_32_hash,
+}
+
 
 class TwemRedis:
     """
@@ -26,7 +83,8 @@ class TwemRedis:
             performed on the shards directly.
     """
 
-    disallowed_sharded_operations = ['hscan', 'scan', 'sscan', 'zscan']
+    disallowed_sharded_operations = frozenset(
+        ['hscan', 'scan', 'sscan', 'zscan'])
 
     def __init__(self, config_file):
         self._config = self._parse_config(config_file)
@@ -34,11 +92,22 @@ class TwemRedis:
         self._shard_name_format = self._config['shard_name_format']
 
         self._hash_tag = self._config['hash_tag']
+        # Like twemproxy, the hash tag is a pair of single characters.
+        if len(self._hash_tag) != 2:
+            raise ValueError("hash_tag must be two characters, got '{0}'"
+                             .format(self._hash_tag))
         self._hash_start = self._hash_tag[0]
         self._hash_stop = self._hash_tag[1]
 
+        self._hash = self._config.get('hash', 'md5')
+        if self._hash not in _HASH_FUNCTIONS:
+            raise ValueError("unsupported hash function '{0}'".format(
+                self._hash))
+        self._hash_func = _HASH_FUNCTIONS[self._hash]
+
         if 'sentinels' in self._config:
             self._sentinels = self._config['sentinels']
+            self._sentinel_pairs = [(h, 8422) for h in self._sentinels]
             self._num_shards = int(self._config['num_shards'])
             self._masters = None
         elif 'masters' in self._config:
@@ -51,7 +120,23 @@ class TwemRedis:
         else:
             self._timeout = 2.0
 
+        self._shard_names = [self._shard_name_format.format(shard_num)
+                             for shard_num in range(0, self._num_shards)]
+
         self._canonical_keys = self.compute_canonical_key_ids()
+        # The canonical key ids never change for an instance, so remember
+        # the ones we've already looked up. The cache is keyed by the str
+        # form of the key id, which is what gets hashed.
+        self._canonical_key_id_cache = lru_cache(maxsize=32768)(
+            self._compute_canonical_key_id)
+
+        # Lua scripts loaded with load_script_on_all_shards, by name.
+        self._scripts = {}
+
+        # Used to fan out multi-shard operations like mget and mset. It's
+        # created on first use by _get_pool.
+        self._pool = None
+        self._pool_pid = None
 
         self._init_redis_shards()
 
@@ -60,8 +145,19 @@ class TwemRedis:
         _parse_config takes a path to a yml file and returns the parsed
         object representation of the file. This is a convenient method
         to override in unit tests.
+
+        Parsed files are cached until their modification time or size
+        changes.
         """
-        return yaml.load(open(config_file, 'r'))
+        st = os.stat(config_file)
+        version = (st.st_mtime_ns, st.st_size)
+        cached = _config_cache.get(config_file)
+        if cached is None or cached[0] != version:
+            with open(config_file, 'r') as f:
+                cached = (version, yaml.load(f, Loader=_YAML_LOADER))
+            _config_cache[config_file] = cached
+
+        return copy.deepcopy(cached[1])
 
     def _init_redis_shards(self):
         """
@@ -69,7 +165,7 @@ class TwemRedis:
         and populate self.shards with the redis.StrictRedis instances. This
         is a convenient method to override / stub out in unit tests.
         """
-        self._shards = {}
+        self._shards = [None] * self._num_shards
         if self._sentinels is not None:
             self.init_shards_from_sentinel()
         elif self._masters is not None:
@@ -79,12 +175,13 @@ class TwemRedis:
 
     def init_shards_from_sentinel(self):
         sentinel_client = Sentinel(
-            [(h, 8422) for h in self._sentinels], socket_timeout=self._timeout)
+            self._sentinel_pairs, socket_timeout=self._timeout)
         # Connect to all the shards with the names specified per
         # shard_name_format. The names are important since it's getting
-        # the instances from Redis Sentinel.
-        for shard_num in range(0, self.num_shards()):
-            shard_name = self.get_shard_name(shard_num)
+        # the instances from Redis Sentinel. master_for doesn't talk to the
+        # sentinels; each master is only resolved once its shard is first
+        # used, so there's no point in doing this concurrently.
+        for shard_num, shard_name in enumerate(self._shard_names):
             self._shards[shard_num] = sentinel_client.master_for(
                 shard_name, socket_timeout=self._timeout)
         # Just in case we need it later.
@@ -114,6 +211,8 @@ class TwemRedis:
 
         Returns the shard name (e.g. tdb001)
         """
+        if 0 <= shard_num < self._num_shards:
+            return self._shard_names[shard_num]
         return self._shard_name_format.format(shard_num)
 
     def get_shard_names(self):
@@ -122,12 +221,7 @@ class TwemRedis:
         in the cluster. This is determined with num_shards and
         shard_name_format
         """
-        results = []
-        for shard_num in range(0, self.num_shards()):
-            shard_name = self.get_shard_name(shard_num)
-            results.append(shard_name)
-
-        return results
+        return list(self._shard_names)
 
     def get_key(self, key_type, key_id):
         """
@@ -139,8 +233,7 @@ class TwemRedis:
         returns a string representing the key
         (e.g.: 'friend_request:{12345}')
         """
-        return "{0}:{1}{2}{3}".format(key_type, self._hash_start, key_id,
-                                      self._hash_stop)
+        return f"{key_type}:{self._hash_start}{key_id}{self._hash_stop}"
 
     def get_shard_by_key(self, key):
         """
@@ -153,6 +246,9 @@ class TwemRedis:
         is the key id.
         returns a redis.StrictRedis connection
         """
+        if self._num_shards == 1:
+            # Every key lives on the only shard; skip finding the key id.
+            return self._shards[0]
         key_id = self._get_key_id_from_key(key)
         return self.get_shard_by_key_id(key_id)
 
@@ -189,18 +285,23 @@ class TwemRedis:
         key_id -- the key id (e.g. '12345' or 'anythingcangohere')
 
         This method is critical in how the Redis cluster sharding works. We
-        emulate twemproxy's md5 distribution algorithm.
+        emulate twemproxy's modula distribution using the hash function named
+        by the 'hash' setting in the configuration file (md5 by default).
         """
-        # TODO: support other hash functions?
-        m = hashlib.md5(str(key_id).encode('ascii')).hexdigest()
-        # Below is borrowed from
-        # https://github.com/twitter/twemproxy/blob/master/src/hashkit/nc_md5.c
-        val = (int(m[0:2], 16) |
-               int(m[2:4], 16) << 8 |
-               int(m[4:6], 16) << 16 |
-               int(m[6:8], 16) << 24)
+        if self._num_shards == 1:
+            return 0
+        return self._shard_num(self._hash_func, str(key_id).encode('utf-8'),
+                               self._num_shards)
 
-        return val % self.num_shards()
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _shard_num(hash_func, key_id_bytes, num_shards):
+        """
+        _shard_num hashes the encoded key id and maps it onto a shard number.
+        Results are memoized since the same key ids tend to be looked up
+        over and over again.
+        """
+        return hash_func(key_id_bytes) % num_shards
 
     def get_canonical_key(self, key_type, key_id):
         """
@@ -229,6 +330,9 @@ class TwemRedis:
 
         returns the canonical key id (e.g. '12')
         """
+        return self._canonical_key_id_cache(str(key_id))
+
+    def _compute_canonical_key_id(self, key_id):
         shard_num = self.get_shard_num_by_key_id(key_id)
         return self._canonical_keys[shard_num]
 
@@ -253,10 +357,15 @@ class TwemRedis:
 
         Returns a redis.StrictRedis connection or raises a ValueError.
         """
-        if shard_num < 0 or shard_num >= self.num_shards():
-            raise ValueError("requested invalid shard# {0}".format(shard_num))
+        # Negative indexes would silently wrap around; anything too large is
+        # caught by the list itself.
+        try:
+            if shard_num >= 0:
+                return self._shards[shard_num]
+        except (IndexError, TypeError):
+            pass
 
-        return self._shards[shard_num]
+        raise ValueError("requested invalid shard# {0}".format(shard_num))
 
     def _get_key_id_from_key(self, key):
         """
@@ -271,17 +380,16 @@ class TwemRedis:
         Returns the key id portion of the key, or the whole key if no hash
         tags are present.
         """
-        key_id = key
+        # Use what's inside the hash tags as the key id, if present.
+        # Otherwise the whole key will be used as the key id.
+        start = key.find(self._hash_start)
+        if start < 0:
+            return key
+        stop = key.find(self._hash_stop, start + 1)
+        if stop < 0:
+            return key
 
-        regex = '{0}([^{1}]*){2}'.format(self._hash_start, self._hash_stop,
-                                         self._hash_stop)
-        m = re.search(regex, key)
-        if m is not None:
-            # Use what's inside the hash tags as the key id, if present.
-            # Otherwise the whole key will be used as the key id.
-            key_id = m.group(1)
-
-        return key_id
+        return key[start + 1:stop]
 
     def compute_canonical_key_ids(self, search_amplifier=100):
         """
@@ -298,17 +406,23 @@ class TwemRedis:
         num_shards = self.num_shards()
         # Guarantees enough to find all keys without running forever
         num_iterations = (num_shards**2) * search_amplifier
+        # The candidate key ids are plain integers, so hash them directly
+        # rather than going through get_shard_num_by_key, which would look
+        # for hash tags in every one of them. The memoized _shard_num is
+        # bypassed too since most candidates are only hashed this once.
+        hash_func = self._hash_func
         for key_id in range(1, num_iterations):
-            shard_num = self.get_shard_num_by_key(str(key_id))
+            key_id = str(key_id)
+            shard_num = hash_func(key_id.encode('utf-8')) % num_shards
             if shard_num in canonical_keys:
                 continue
-            canonical_keys[shard_num] = str(key_id)
+            canonical_keys[shard_num] = key_id
             if len(canonical_keys) == num_shards:
                 break
 
         if len(canonical_keys) != num_shards:
             raise ValueError("Failed to compute enough keys. " +
-                             "Wanted %d, got %d (search_amp=%d).".format(
+                             "Wanted {0}, got {1} (search_amp={2}).".format(
                                  num_shards, len(canonical_keys),
                                  search_amplifier))
 
@@ -321,6 +435,49 @@ class TwemRedis:
             results[shard_num] = closure(shard)
         return results
 
+    def load_script_on_all_shards(self, name, script):
+        """
+        load_script_on_all_shards loads a Lua script on every shard so it can
+        later be run with evalsha_on_shard. Combining several commands that
+        touch the same shard into one script saves a round trip per extra
+        command.
+
+        Keyword arguments:
+        name -- the name to refer to the script by (e.g. 'incr_and_expire')
+        script -- the Lua source of the script
+
+        Returns the script's SHA1.
+        """
+        # SCRIPT LOAD returns the SHA1 of the source, the same on every shard.
+        sha = _sha1(script.encode('utf-8')).hexdigest()
+        self.execute_on_all_shards(lambda shard: shard.script_load(script))
+        self._scripts[name] = (script, sha)
+        return sha
+
+    def evalsha_on_shard(self, name, key, *args):
+        """
+        evalsha_on_shard runs a script loaded with load_script_on_all_shards
+        on the shard that key belongs to, with key as its only KEYS entry and
+        args as ARGV. If the shard no longer has the script cached (e.g. after
+        a failover), it is loaded again.
+
+        Keyword arguments:
+        name -- the name the script was loaded with
+        key -- the key the script operates on (e.g. 'friend_request:{12345}')
+
+        Returns the result of the script.
+        """
+        if name not in self._scripts:
+            raise ValueError("unknown script '{0}'".format(name))
+        (script, sha) = self._scripts[name]
+
+        shard = self.get_shard_by_key(key)
+        try:
+            return shard.evalsha(sha, 1, key, *args)
+        except NoScriptError:
+            shard.script_load(script)
+            return shard.evalsha(sha, 1, key, *args)
+
     def run_on_all_shards(self, func, *args, **kwargs):
         results = {}
         for shard_num in range(0, self.num_shards()):
@@ -348,6 +505,50 @@ class TwemRedis:
             results[shard_num] = shard.keys(args)
         return results
 
+    def route(self, keys):
+        """
+        route groups keys by the shard they belong to, so callers building
+        their own multi-key commands get every shard's batch from one call.
+        Each key is still hashed individually with get_shard_num_by_key.
+
+        Keyword arguments:
+        keys -- an iterable of keys (e.g. ['friends:{1}', 'friends:{2}'])
+
+        Returns a dictionary mapping shard numbers to the list of keys on
+        that shard, in the order they were given. Shards without any of the
+        keys are left out.
+        """
+        if self._num_shards == 1:
+            keys = list(keys)
+            return {0: keys} if keys else {}
+
+        # Bucket the keys in a single pass, indexing buckets by shard number.
+        buckets = [[] for _ in range(self._num_shards)]
+        get_shard_num_by_key = self.get_shard_num_by_key
+        for key in keys:
+            buckets[get_shard_num_by_key(key)].append(key)
+
+        return dict((shard_num, shard_keys)
+                    for shard_num, shard_keys in enumerate(buckets)
+                    if shard_keys)
+
+    def _route_items(self, mapping):
+        """
+        _route_items is like route, but groups a dictionary's items so each
+        shard gets a dictionary of its keys and their values.
+        """
+        if self._num_shards == 1:
+            return {0: dict(mapping)} if mapping else {}
+
+        buckets = [{} for _ in range(self._num_shards)]
+        get_shard_num_by_key = self.get_shard_num_by_key
+        for key, value in mapping.items():
+            buckets[get_shard_num_by_key(key)][key] = value
+
+        return dict((shard_num, shard_items)
+                    for shard_num, shard_items in enumerate(buckets)
+                    if shard_items)
+
     def mget(self, args):
         """
         mget wrapper that batches keys per shard and execute as few
@@ -356,17 +557,9 @@ class TwemRedis:
         This method should be invoked on a TwemRedis instance as if it
         were being invoked directly on a StrictRedis instance.
         """
-        key_map = collections.defaultdict(list)
-        results = {}
-        for key in args:
-            shard_num = self.get_shard_num_by_key(key)
-            key_map[shard_num].append(key)
-
-        # TODO: parallelize
-        for shard_num in key_map.keys():
-            shard = self.get_shard_by_num(shard_num)
-            results[shard_num] = shard.mget(key_map[shard_num])
-        return results
+        key_map = self.route(args)
+        return self._execute_on_shards(
+            key_map, lambda shard, keys: shard.mget(keys))
 
     def mset(self, args):
         """
@@ -376,19 +569,90 @@ class TwemRedis:
         This method should be invoked on a TwemRedis instance as if it
         were being invoked directly on a StrictRedis instance.
         """
-        key_map = collections.defaultdict(dict)
-        result_count = 0
-        for key in args.keys():
-            value = args[key]
-            shard_num = self.get_shard_num_by_key(key)
-            key_map[shard_num][key] = value
+        key_map = self._route_items(args)
+        results = self._execute_on_shards(
+            key_map, lambda shard, mapping: shard.mset(mapping))
+        return sum(results.values())
 
-        # TODO: parallelize
-        for shard_num in key_map.keys():
+    def mexecute(self, func, args):
+        """
+        mexecute batches calls to a single key operation per shard and sends
+        each batch as one non-transactional pipeline, so every shard involved
+        is only visited once. Use this for operations that have no native
+        multi-key form (e.g. hset or expire); mget and mset should be used
+        where they apply.
+
+        Keyword arguments:
+        func -- the name of the StrictRedis method to call (e.g. 'hset')
+        args -- a dictionary mapping each key to a tuple of the remaining
+                arguments for func (e.g. {'user:{1}': ('name', 'bob')})
+
+        Returns a dictionary mapping shard numbers to the list of results
+        for the keys on that shard, in the order they were pipelined.
+        """
+        if func in self.disallowed_sharded_operations:
+            raise Exception("Cannot call '{0}' on sharded Redis".format(func))
+
+        key_map = self._route_items(args)
+
+        def pipelined(shard, calls):
+            pipe = shard.pipeline(transaction=False)
+            for (key, func_args) in calls.items():
+                getattr(pipe, func)(key, *func_args)
+            return pipe.execute()
+
+        return self._execute_on_shards(key_map, pipelined)
+
+    def _execute_on_shards(self, key_map, closure):
+        """
+        _execute_on_shards runs closure on every shard in key_map concurrently,
+        passing each shard its own batch of arguments.
+
+        Keyword arguments:
+        key_map -- dictionary mapping shard numbers to the batch for the shard
+        closure -- called as closure(shard, batch) for each shard
+
+        Returns a dictionary mapping shard numbers to the results of closure.
+        """
+        if not key_map:
+            return {}
+        if len(key_map) == 1:
+            # Nothing to run concurrently; skip the thread hand-off.
+            for shard_num, batch in key_map.items():
+                return {shard_num: closure(self.get_shard_by_num(shard_num),
+                                           batch)}
+
+        pool = self._get_pool()
+        futures = {}
+        for shard_num, batch in key_map.items():
             shard = self.get_shard_by_num(shard_num)
-            result_count += shard.mset(key_map[shard_num])
+            futures[shard_num] = pool.submit(closure, shard, batch)
 
-        return result_count
+        return dict((shard_num, future.result())
+                    for shard_num, future in futures.items())
+
+    def _get_pool(self):
+        """
+        _get_pool returns the thread pool used by _execute_on_shards, creating
+        it if needed. A forked child doesn't inherit the pool's worker
+        threads, so a new pool is created whenever the process id changes.
+        """
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            self._pool = ThreadPoolExecutor(max_workers=self._num_shards)
+            self._pool_pid = pid
+        return self._pool
+
+    def shutdown_pool(self):
+        """
+        shutdown_pool shuts down the thread pool used for multi-shard
+        operations. It will be recreated if such an operation is performed
+        again. The shards' own connections are left open.
+        """
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+        self._pool_pid = None
 
     def __getattr__(self, func_name):
         """
@@ -397,11 +661,21 @@ class TwemRedis:
         shard. Certain operations like KEYS and MGET are supported but are
         handled in their own wrapper methods.
         """
-        def func(key, *args, **kwargs):
-            if (func_name in self.disallowed_sharded_operations):
-                raise Exception("Cannot call '%s' on sharded Redis".format(
+        if func_name.startswith('_'):
+            # Not a Redis operation; don't shadow Python's own protocols.
+            raise AttributeError(func_name)
+
+        if func_name in self.disallowed_sharded_operations:
+            def disallowed(*args, **kwargs):
+                raise Exception("Cannot call '{0}' on sharded Redis".format(
                     func_name))
+            return disallowed
+
+        def func(key, *args, **kwargs):
+            return getattr(self.get_shard_by_key(key), func_name)(
+                key, *args, **kwargs)
 
-            shard = self.get_shard_by_key(key)
-            return getattr(shard, func_name)(key, *args, **kwargs)
+        # Cache the wrapper on the instance so later lookups of the same
+        # operation don't go through __getattr__ again.
+        self.__dict__[func_name] = func
         return func